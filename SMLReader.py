@@ -1,8 +1,8 @@
+import mmap
+import numpy
 import os
 import struct
 
-from typing import cast
-
 from UM.Job import Job
 from UM.Logger import Logger
 from UM.Mesh.MeshReader import MeshReader
@@ -10,12 +10,36 @@ from UM.Mesh.MeshBuilder import MeshBuilder
 from UM.MimeTypeDatabase import MimeTypeDatabase, MimeType
 from UM.Scene.SceneNode import SceneNode
 
+# Prefer google-crc32c, which uses the CPU's CRC32 instruction, but only if its C extension
+# is available; its pure-Python fallback is far slower than the crc32c package.
 have_crc32c = False
 try:
-    import crc32c
+    import google_crc32c
+    if google_crc32c.implementation != "c":
+        raise ImportError("google-crc32c has no hardware implementation")
+
+    def crc32cUpdate(data: bytes, crc: int) -> int:
+        return google_crc32c.extend(crc, data)
+
     have_crc32c = True
 except ImportError:
-    Logger.log("w", "CRC32C not found, skipping SML integrity checks.")
+    try:
+        import crc32c
+        crc32cUpdate = crc32c.crc32c
+        have_crc32c = True
+    except ImportError:
+        Logger.log("w", "CRC32C not found, skipping SML integrity checks.")
+
+# Bytes checksummed per crc32c call; large enough that call overhead is negligible, small enough
+# that a huge segment is never copied out of the buffer in one piece.
+_CRC_CHUNK_SIZE = 1 << 20
+# Files smaller than this are read into memory in one go; larger ones are memory-mapped instead.
+_READ_AHEAD_LIMIT = 64 << 20
+# File header: magic and CRC32C of everything after it. Segment header: type and length.
+_FILE_HEADER = struct.Struct("<4sI")
+_SEGMENT_HEADER = struct.Struct("<BI")
+# Bytes of segments parsed between yields, so files made of many small segments don't yield after each one.
+_YIELD_INTERVAL = 4 << 20
     
 
 class SMLReader(MeshReader):
@@ -30,173 +54,158 @@ class SMLReader(MeshReader):
         )
         self._supported_extensions = [".sml"]
 
+    # Unpacks `count` little-endian vertices of the given dtype into a contiguous float32 (N, 3) array,
+    # swapping Y and Z and negating the new Z since SML is Z-up and Cura is Y-up.
+    def _readVertexList(self, buffer, offset: int, count: int, dtype: str) -> numpy.ndarray:
+        raw = numpy.frombuffer(buffer, dtype = dtype, count = count * 3, offset = offset).reshape(-1, 3)
+        # Write each output column straight from the source column, converting to float32 on the way,
+        # so the swap and negation take one pass with no intermediate copy.
+        vertex_list = numpy.empty((len(raw), 3), dtype = numpy.float32)
+        vertex_list[:, 0] = raw[:, 0]
+        vertex_list[:, 1] = raw[:, 2]
+        numpy.negative(raw[:, 1], out = vertex_list[:, 2], casting = "same_kind")
+        return vertex_list
+
+    # Unpacks `count` faces of `corners` indices each into an (N, corners) index array, dropping
+    # every face that references a vertex out of range. Bad faces are reported once per segment.
+    def _readFaceList(self, buffer, offset: int, count: int, corners: int, vertices: int) -> numpy.ndarray:
+        face_list = numpy.frombuffer(buffer, dtype = "<u4", count = count * corners, offset = offset).reshape(-1, corners)
+        valid = face_list.max(axis = 1) < vertices
+        bad = len(valid) - int(numpy.count_nonzero(valid))
+        if bad:
+            first = int(numpy.argmin(valid))
+            Logger.log("e", "Vertex index out of range in %s of %s faces, first at %s: %s vertices=%s", bad, len(valid), first, face_list[first].tolist(), vertices)
+        # We can just drop the bad faces and keep going.
+        return face_list[valid]
+
+    # Expands a strip of `count` indices into an (N, 3) triangle index array. Triangle k uses strip
+    # indices k, k+1 and k+2, with the first two swapped on odd k so every triangle keeps the same winding.
+    # Triangles using an out-of-range index are dropped; one bad index costs up to three triangles.
+    def _readTriangleStrip(self, buffer, offset: int, count: int, vertices: int) -> numpy.ndarray:
+        strip = numpy.frombuffer(buffer, dtype = "<u4", count = count, offset = offset)
+        invalid = strip >= vertices
+        bad = int(numpy.count_nonzero(invalid))
+        if bad:
+            first = int(numpy.argmax(invalid))
+            Logger.log("e", "Vertex index out of range in %s of %s strip indices, first at strip offset %s: index=%s vertices=%s", bad, len(strip), first, strip[first], vertices)
+
+        face_list = numpy.stack((strip[:-2], strip[1:-1], strip[2:]), axis = 1)
+        face_list[1::2, [0, 1]] = face_list[1::2, [1, 0]]
+        return face_list[face_list.max(axis = 1, initial = 0) < vertices]
+
+    def _closeBuffer(self, buffer) -> None:
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+
     def _read(self, file_name):
         scene_node = None
 
         extension = os.path.splitext(file_name)[1]
         if extension.lower() in self._supported_extensions:
-            vertex_list = []
+            # Every vertex segment is kept, and each face segment's (N, 3) corner indices are offset by `base`
+            # to address the concatenated vertex array. The triangle corners are gathered from it once at the end.
+            vertex_lists = []
+            index_lists = []
+            vertices = 0
+            base = 0
             scene_node = SceneNode()
 
             mesh_builder = MeshBuilder()
             mesh_builder.setFileName(file_name)
             f = open(file_name, "rb")
 
-            f.seek(0, os.SEEK_END)
-            size = f.tell()
+            size = os.fstat(f.fileno()).st_size
             if size < 13:
-                Logger.logException("e", "SML file truncated or empty: Size is less than 13 bytes.")
+                Logger.log("e", "SML file truncated or empty: Size is less than 13 bytes.")
+                f.close()
                 return None
-            f.seek(0, os.SEEK_SET)
+            # Parse the whole file by offset from a single buffer; a mapping outlives the file handle.
+            if size < _READ_AHEAD_LIMIT:
+                buffer = f.read()
+            else:
+                buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            f.close()
             
-            header = struct.unpack(b"4s", f.read(4))
-            if header[0] != b"SML1" and header[0] != "SML1":
-                Logger.logException("e", "SML header invalid. Expected 'SML1' got '%s'", header[0])
+            header, crc = _FILE_HEADER.unpack_from(buffer, 0)
+            if header != b"SML1":
+                Logger.log("e", "SML header invalid. Expected 'SML1' got '%s'", header)
+                self._closeBuffer(buffer)
                 return None
             
-            crc = cast(int, struct.unpack("<I", f.read(4))[0])
-            if have_crc32c:
-                checkcrc = 0
-                for i in range(8, size, 65536):
-                    data = f.read(65536)
-                    checkcrc = crc32c.crc32c(data, checkcrc)
-                    Job.yieldThread()
-                if crc != checkcrc:
-                    Logger.log("e", "SML CRC check failed. Expected '{:#010x}' got '{:#010x}'".format(crc, checkcrc))
-                    # May as well try to laod it anyhow, shouldn't do any harm.
-                    #return None
+            checkcrc = 0
 
-            f.seek(8, os.SEEK_SET)
+            yieldpos = 8 # Position of the last Job.yieldThread().
             pos = 8
             while pos < size:
-                realpos = f.tell()
-                if pos != realpos:
-                    Logger.logException("e", "Summed position %s does not match actual position %s.", pos, realpos)
-                    pos = realpos
-                
                 #Logger.log("i", "SML segment starting at position %s of size %s.", pos, size)
-                segtype = cast(int, struct.unpack("B", f.read(1))[0])
-                seglength = cast(int, struct.unpack("<I", f.read(4))[0])
-                pos += 5
+                segtype, seglength = _SEGMENT_HEADER.unpack_from(buffer, pos)
+                pos += _SEGMENT_HEADER.size
+                offset = pos # Start of this segment's data.
                 if pos + seglength > size:
-                    Logger.logException("e", "SML file truncated: Position %s + segment %s would exceed file size %s.", pos, seglength, size)
+                    Logger.log("e", "SML file truncated: Position %s + segment %s would exceed file size %s.", pos, seglength, size)
+                    self._closeBuffer(buffer)
                     return None
                 pos += seglength
                 #Logger.log("i", "SML segment type %s, segment length %s.", segtype, seglength)
+                if have_crc32c:
+                    # Checksum each segment, header included, as it is parsed instead of making a separate pass over the file.
+                    # google-crc32c only accepts bytes, so slice the buffer rather than a memoryview.
+                    for i in range(offset - _SEGMENT_HEADER.size, pos, _CRC_CHUNK_SIZE):
+                        checkcrc = crc32cUpdate(buffer[i:min(i + _CRC_CHUNK_SIZE, pos)], checkcrc)
                     
                 if segtype == 0: # Comment
-                    f.seek(seglength, os.SEEK_CUR)
+                    pass
                     
                 elif segtype == 1: # Float vertex list
                     count = seglength // 12
-                    vertex_list = []
-                    for i in range(count):
-                        vertex = struct.unpack(b"<fff", f.read(12))
-                        vertex_list.append([float(vertex[0]), float(vertex[2]), -float(vertex[1])])
-                        #Logger.log("i", "Vertex: %s %s %s", float(vertex[0]), float(vertex[2]), -float(vertex[1]))
-                        Job.yieldThread()
+                    vertex_list = self._readVertexList(buffer, offset, count, "<f4")
+                    base += vertices
                     vertices = len(vertex_list)
+                    vertex_lists.append(vertex_list)
                     Logger.log("i", "Loaded %s float vertices.", vertices)
                 
                 elif segtype == 2: # Double vertex list
                     count = seglength // 24
-                    vertex_list = []
-                    for i in range(count):
-                        vertex = struct.unpack(b"<ddd", f.read(24))
-                        vertex_list.append([float(vertex[0]), float(vertex[2]), -float(vertex[1])])
-                        Job.yieldThread()
+                    vertex_list = self._readVertexList(buffer, offset, count, "<f8")
+                    base += vertices
                     vertices = len(vertex_list)
+                    vertex_lists.append(vertex_list)
                     Logger.log("i", "Loaded %s double vertices.", vertices)
                 
                 elif segtype == 3: # Triangle list
                     count = seglength // 12
-                    for i in range(count):
-                        face = struct.unpack(b"<III", f.read(12))
-                        a = cast(int, face[0])
-                        b = cast(int, face[1])
-                        c = cast(int, face[2])
-                        
-                        #Logger.log("Triangle: %s %s %s", a, b, c)
-                        if a >= vertices or b >= vertices or c >= vertices:
-                            Logger.logException("e", "Vertex index out of range at %s: a=%s b=%s c=%s vertices=%s", i, a, b, c, vertices)
-                            # We can just drop the triangle and keep going.
-                            #return None
-                            continue
-                        
-                        mesh_builder.addFaceByPoints(
-                            vertex_list[a][0], vertex_list[a][1], vertex_list[a][2], 
-                            vertex_list[b][0], vertex_list[b][1], vertex_list[b][2], 
-                            vertex_list[c][0], vertex_list[c][1], vertex_list[c][2])
-
-                        #Logger.log("Triangle: %s %s %s / %s %s %s / %s %s %s", 
-                        #    vertex_list[a][0], vertex_list[a][1], vertex_list[a][2], 
-                        #    vertex_list[b][0], vertex_list[b][1], vertex_list[b][2], 
-                        #    vertex_list[c][0], vertex_list[c][1], vertex_list[c][2])
-                        Job.yieldThread()
-                
+                    face_list = self._readFaceList(buffer, offset, count, 3, vertices)
+                    index_lists.append(face_list + base)
+
                 elif segtype == 4: # Quad list
                     count = seglength // 16
-                    for i in range(count):
-                        face = struct.unpack(b"<IIII", f.read(16))
-                        a = cast(int, face[0])
-                        b = cast(int, face[1])
-                        c = cast(int, face[2])
-                        d = cast(int, face[3])
-
-                        if a >= vertices or b >= vertices or c >= vertices or d >= vertices:
-                            Logger.logException("e", "Vertex index out of range at %s: a=%s b=%s c=%s d=%s vertices=%s", i, a, b, c, d, vertices)
-                            continue
-
-                        mesh_builder.addFaceByPoints(
-                            vertex_list[a][0], vertex_list[a][1], vertex_list[a][2], 
-                            vertex_list[b][0], vertex_list[b][1], vertex_list[b][2], 
-                            vertex_list[c][0], vertex_list[c][1], vertex_list[c][2])
-                        mesh_builder.addFaceByPoints(
-                            vertex_list[a][0], vertex_list[a][1], vertex_list[a][2], 
-                            vertex_list[c][0], vertex_list[c][1], vertex_list[c][2], 
-                            vertex_list[d][0], vertex_list[d][1], vertex_list[d][2])
-                        Job.yieldThread()
+                    quad_list = self._readFaceList(buffer, offset, count, 4, vertices)
+                    # Split each quad abcd into abc and acd, keeping both halves next to each other.
+                    face_list = numpy.stack((quad_list[:, [0, 1, 2]], quad_list[:, [0, 2, 3]]), axis = 1).reshape(-1, 3)
+                    index_lists.append(face_list + base)
                 
                 elif segtype == 5: # Triangle strip
                     count = seglength // 4
-
-                    face = struct.unpack(b"<III", f.read(12))
-                    a = int(face[0])
-                    b = int(face[1])
-                    c = int(face[2])
-                    
-                    if a >= vertices or b >= vertices or c >= vertices:
-                        Logger.logException("e", "Vertex index out of range for strip initial triangle: a=%s b=%s c=%s vertices=%s", i, a, b, c, vertices)
-                    else:
-                        # With strips, the error will propagate for a bit, but assuming there's valid triangles down the road it should recover.
-                        mesh_builder.addFaceByPoints(
-                            vertex_list[a][0], vertex_list[a][1], vertex_list[a][2], 
-                            vertex_list[b][0], vertex_list[b][1], vertex_list[b][2], 
-                            vertex_list[c][0], vertex_list[c][1], vertex_list[c][2])
-                        
-                    for i in range(3, count):
-                        if i & 1:
-                            b = c
-                        else:
-                            a = c
-                        c = cast(int, struct.unpack("<I", f.read(4))[0])
-
-                        if c >= vertices:
-                            Logger.logException("e", "Vertex index out of range at strip offset %s: c=%s vertices=%s", i, c, vertices)
-                        else:
-                            mesh_builder.addFaceByPoints(
-                                vertex_list[a][0], vertex_list[a][1], vertex_list[a][2], 
-                                vertex_list[b][0], vertex_list[b][1], vertex_list[b][2], 
-                                vertex_list[c][0], vertex_list[c][1], vertex_list[c][2])
-                        Job.yieldThread()
+                    face_list = self._readTriangleStrip(buffer, offset, count, vertices)
+                    index_lists.append(face_list + base)
                  
                 else: # Unsupported type, ignore it and hope for the best.
-                    Logger.logException("e", "SML file contains unsupported segment type; ignoring.")
-                    f.seek(seglength, os.SEEK_CUR)
+                    Logger.log("e", "SML file contains unsupported segment type; ignoring.")
                 
-                Job.yieldThread()
-            f.close()
+                if pos - yieldpos >= _YIELD_INTERVAL:
+                    Job.yieldThread()
+                    yieldpos = pos
+            self._closeBuffer(buffer)
+
+            if have_crc32c and crc != checkcrc:
+                Logger.log("e", "SML CRC check failed. Expected '{:#010x}' got '{:#010x}'".format(crc, checkcrc))
+                # May as well use what we loaded anyhow, shouldn't do any harm.
+                #return None
             
+            # Leave the builder empty unless some face survived, as a file without faces always did.
+            face_list = numpy.concatenate(index_lists) if index_lists else None
+            if face_list is not None and face_list.size:
+                mesh_builder.setVertices(numpy.concatenate(vertex_lists)[face_list.reshape(-1)])
             mesh_builder.calculateNormals(fast = True)
             scene_node.setMeshData(mesh_builder.build())
         return scene_node